@@ -1,74 +1,35 @@
 import base64
-import io
+import functools
+import gzip
 import logging
+import orjson
 import time
 import requests
+import threading
 import urllib.parse
 
 import asciichartpy as asciichart
 
-from azure.core.credentials import TokenCredential
-from dataclasses import dataclass
-from gzip import GzipFile
-from tabulate import tabulate
-from typing import Any
+from azure.core.credentials import AccessToken, TokenCredential
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from .terminal import get_link
+from .query import _Query, poll_until_non_zero
+from .table import GroupDefinition, Table
+from .terminal import STDOUT_IS_TTY, colour, get_link, print_table
 
 APPINSIGHTS_ENDPOINT = "https://api.applicationinsights.io/v1/apps"
+APPINSIGHTS_SCOPE = "https://api.applicationinsights.io/.default"
 
+# Refresh the cached access token when it is within this many seconds of expiring
+TOKEN_REFRESH_THRESHOLD_SECONDS = 60
 
-@dataclass
-class GroupDefinition:
-    id_column: str
-    group_column: str
-    value_column: str
-    missing_value: Any = None
+# (connect, read) timeouts in seconds for App Insights queries
+QUERY_TIMEOUT_SECONDS = (5, 60)
 
-
-@dataclass
-class Table:
-    columns: list[str]
-    rows: list[list[Any]]
-
-    def group_by(
-        self,
-        id_column: str,
-        group_column: str,
-        value_column: str,
-        missing_value: Any = None,
-    ) -> "Table":
-
-        # assume rows are sorted on id_column
-
-        group_column_index = self.columns.index(group_column)
-        distinct_group_column_values = sorted(
-            list(set(row[group_column_index] for row in self.rows))
-        )
-
-        new_columns = [id_column] + [
-            f"{value_column}_{name}" for name in distinct_group_column_values
-        ]
-
-        id_column_index = self.columns.index(id_column)
-        value_column_index = self.columns.index(value_column)
-
-        # Produce a new table where each row has the id_column and a column for each distinct value in group_column with the value of value_column
-        rows = []
-        current_row = None
-        for row in self.rows:
-            if current_row is None or current_row[0] != row[id_column_index]:
-                if current_row is not None:
-                    rows.append(current_row)
-                # start new row
-                current_row = [row[id_column_index]] + (
-                    [missing_value] * len(distinct_group_column_values)
-                )
-            group = row[group_column_index]
-            value = row[value_column_index]
-            current_row[distinct_group_column_values.index(group) + 1] = value
-
-        return Table(rows=rows, columns=new_columns)
+# Maximum number of queries to run in parallel in run_queries
+MAX_CONCURRENT_QUERIES = 8
 
 
 def parse_app_id_from_connection_string(connection_string):
@@ -78,6 +39,7 @@ def parse_app_id_from_connection_string(connection_string):
     return None
 
 
+@functools.lru_cache(maxsize=256)
 def get_app_insights_portal_url(
     tenant_id: str,
     subscription_id: str,
@@ -88,29 +50,39 @@ def get_app_insights_portal_url(
 ):
     """
     Build a URL to deep link into the Azure Portal to run a query in Application Insights.
+    Results are cached so repeated run_queries calls with the same query reuse the URL.
     """
     # Get the UTF8 bytes for the query
     query_bytes = query.encode("utf-8")
 
-    # GZip the query bytes
-    bio_out = io.BytesIO()
-    with GzipFile(mode="wb", fileobj=bio_out) as gzip:
-        gzip.write(query_bytes)
+    # GZip the query bytes (mtime=0 so the same query always produces the same URL)
+    zipped_bytes = gzip.compress(query_bytes, compresslevel=6, mtime=0)
 
-    # Base64 encode the result
-    zipped_bytes = bio_out.getvalue()
-    base64_query = base64.b64encode(zipped_bytes)
+    # Base64 encode the result (base64 output is ASCII so decode to a str for quoting)
+    base64_query = base64.b64encode(zipped_bytes).decode("ascii")
 
     # URL encode the base64 encoded query
     encodedQuery = urllib.parse.quote(base64_query, safe="")
 
-    return (
-        f"https://portal.azure.com#@{tenant_id}/blade/Microsoft_Azure_Monitoring_Logs/"
-        + f"LogsBlade/resourceId/%2Fsubscriptions%2F{subscription_id}%2FresourceGroups%2F"
-        + f"{resource_group_name}%2Fproviders%2Fmicrosoft.insights%2Fcomponents%2F"
-        + f"{app_insights_name}/source/LogsBlade.AnalyticsShareLinkToQuery/q/{encodedQuery}"
-        + f"/timespan/{timespan}"
+    resource_id = (
+        f"/subscriptions/{subscription_id}/resourceGroups/{resource_group_name}"
+        + f"/providers/microsoft.insights/components/{app_insights_name}"
     )
+    path_segments = [
+        "blade",
+        "Microsoft_Azure_Monitoring_Logs",
+        "LogsBlade",
+        "resourceId",
+        urllib.parse.quote(resource_id, safe=""),
+        "source",
+        "LogsBlade.AnalyticsShareLinkToQuery",
+        "q",
+        encodedQuery,
+        "timespan",
+        urllib.parse.quote(timespan, safe=""),
+    ]
+    encoded_tenant_id = urllib.parse.quote(tenant_id, safe="")
+    return f"https://portal.azure.com#@{encoded_tenant_id}/" + "/".join(path_segments)
 
 
 class QueryProcessor:
@@ -143,12 +115,45 @@ class QueryProcessor:
             raise ValueError("app_id is required")
         self.__app_id = app_id
         self.__token_credential = token_credential
+        self.__access_token: AccessToken | None = None
+        # run_queries fetches on multiple threads so guard the token refresh
+        self.__access_token_lock = threading.Lock()
+        self.__session = requests.Session()
+        self.__session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=4,
+                # one connection per concurrent query in run_queries
+                pool_maxsize=MAX_CONCURRENT_QUERIES,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.5,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    # queries are read-only so are safe to retry
+                    allowed_methods=["POST"],
+                    # return the final response so that run_query can report the error
+                    raise_on_status=False,
+                ),
+            ),
+        )
         self.__queries = []
         self.__tenant_id = tenant_id
         self.__subscription_id = subscription_id
         self.__resource_group_name = resource_group_name
         self.__app_insights_name = app_insights_name
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes the HTTP session used to run queries.
+        """
+        self.__session.close()
+
     def add_query(
         self,
         title,
@@ -156,9 +161,9 @@ class QueryProcessor:
         validation_func=None,
         timespan="PT12H",
         is_chart=False,
-        columns=[],
+        columns=None,
         group_definition: GroupDefinition | None = None,
-        chart_config=dict(),
+        chart_config=None,
         show_query=False,
         include_link=False,
     ):
@@ -179,18 +184,28 @@ class QueryProcessor:
             include_link (bool): If true then a link to the query in the Azure Portal is printed. Requires tenant, subscription, resource group  and app insights name to be set
         """
 
+        if include_link and None in (
+            self.__tenant_id,
+            self.__subscription_id,
+            self.__resource_group_name,
+            self.__app_insights_name,
+        ):
+            raise ValueError(
+                "tenant_id/subscription_id/resource_group_name/app_insights_name are required when include_link=True"
+            )
+
         self.__queries.append(
-            (
-                title,
-                query,
-                validation_func,
-                timespan,
-                is_chart,
-                columns,
-                chart_config,
-                group_definition,
-                show_query,
-                include_link,
+            _Query(
+                title=title,
+                query=query,
+                validation_func=validation_func,
+                timespan=timespan,
+                is_chart=is_chart,
+                columns=columns or [],
+                chart_config=chart_config or {},
+                group_definition=group_definition,
+                show_query=show_query,
+                include_link=include_link,
             )
         )
 
@@ -198,38 +213,34 @@ class QueryProcessor:
         """
         Runs queries stored in __queries and prints result to stdout.
         """
+        query_results = self.__fetch_query_results()
+
         query_error_count = 0
-        for query_index, (
-            title,
-            query,
-            validation_func,
-            timespan,
-            is_chart,
-            columns,
-            chart_config,
-            group_definition,
-            show_query,
-            include_link,
-        ) in enumerate(self.__queries):
+        for query_index, (query_definition, (result, error_message)) in enumerate(
+            zip(self.__queries, query_results)
+        ):
+            title = query_definition.title
+            query = query_definition.query
+            group_definition = query_definition.group_definition
+            columns = query_definition.columns
             print()
             print(f"Running query {query_index + 1} of {len(self.__queries)}")
-            print(f"{asciichart.yellow}{title}{asciichart.reset}")
-            if show_query:
+            print(colour(title, asciichart.yellow))
+            if query_definition.show_query:
                 print(query)
                 print("")
-            if include_link:
+            if query_definition.include_link:
                 url = get_app_insights_portal_url(
                     self.__tenant_id,
                     self.__subscription_id,
                     self.__resource_group_name,
                     self.__app_insights_name,
                     query,
-                    timespan,
+                    query_definition.timespan,
                 )
                 link = get_link("Run in App Insights", url)
                 print(link)
                 print("")
-            result, error_message = self.run_query(query, timespan)
 
             if error_message:
                 print()
@@ -255,17 +266,22 @@ class QueryProcessor:
                 ]
                 columns = sorted(columns)
 
-            if is_chart:
-                self.__output_chart(result, title, columns, chart_config)
+            if query_definition.is_chart:
+                self.__output_chart(
+                    result, title, columns, query_definition.chart_config
+                )
             else:
                 self.__output_table(result, title)
 
             # Validate result
-            if validation_func:
-                validation_error = validation_func(result)
+            if query_definition.validation_func:
+                validation_error = query_definition.validation_func(result)
                 if validation_error:
                     print(
-                        f"{asciichart.red}Query '{title}' failed with validation error: {validation_error}{asciichart.reset}"
+                        colour(
+                            f"Query '{title}' failed with validation error: {validation_error}",
+                            asciichart.red,
+                        )
                     )
                     query_error_count += 1
                     continue
@@ -274,6 +290,28 @@ class QueryProcessor:
 
         return query_error_count
 
+    def __fetch_query_results(self):
+        """
+        Runs the queries stored in __queries concurrently.
+
+        Returns:
+            List of (result, error_message) tuples in the same order as __queries.
+        """
+        if not self.__queries:
+            return []
+
+        def fetch(query_definition: _Query):
+            # Report failures per query so that one failing query (e.g. a token or
+            # response parsing error) doesn't discard the results of the others
+            try:
+                return self.run_query(query_definition.query, query_definition.timespan)
+            except Exception as e:
+                return None, str(e)
+
+        max_workers = min(MAX_CONCURRENT_QUERIES, len(self.__queries))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(fetch, self.__queries))
+
     def run_query(self, query, timespan) -> tuple[Table, str]:
         """
         Runs a query on a given timespan.
@@ -288,37 +326,62 @@ class QueryProcessor:
             Error code if any.
         """
 
-        headers = {
-            "Authorization": f"Bearer {self.__token_credential.get_token('https://api.applicationinsights.io/.default').token}"
-        }
+        headers = {"Authorization": f"Bearer {self.__get_access_token()}"}
         url = f"{APPINSIGHTS_ENDPOINT}/{self.__app_id}/query?timespan={timespan}"
-        response = requests.post(
-            url,
-            headers=headers,
-            json={"query": query},
-        )
+        try:
+            response = self.__session.post(
+                url,
+                headers=headers,
+                json={"query": query},
+                timeout=QUERY_TIMEOUT_SECONDS,
+            )
+        except requests.RequestException as e:
+            # e.g. timeouts or connection errors once retries are exhausted
+            return None, str(e)
 
         if response.status_code != 200:
             return None, response.content
         else:
-            primaryTable = response.json()["tables"][0]
+            # Parse the body bytes directly (no intermediate str) and release the response
+            # before building the table so the raw body isn't held alongside both the
+            # parsed rows and the table columns
+            primaryTable = orjson.loads(response.content)["tables"][0]
+            del response
             primaryTable = self.__create_table_from_json_response(primaryTable)
             return primaryTable, None
 
-    def wait_for_non_zero_count(self, query, max_retries=10, wait_time_seconds=30):
+    def __get_access_token(self) -> str:
         """
-        Run a query until it returns a non-zero count.
+        Returns a bearer token for App Insights, reusing the cached token until it is close to expiry.
         """
-        for _ in range(max_retries):
-            r, _ = self.run_query(query=query, timespan="P1D")
-            count = r.rows[0][0]
-            if count > 0:
-                logging.info("✔️ Found metrics data")
-                return
-            logging.info("⏳ Waiting for metrics data...")
-            time.sleep(wait_time_seconds)
+        with self.__access_token_lock:
+            if (
+                self.__access_token is None
+                or self.__access_token.expires_on - time.time()
+                < TOKEN_REFRESH_THRESHOLD_SECONDS
+            ):
+                self.__access_token = self.__token_credential.get_token(
+                    APPINSIGHTS_SCOPE
+                )
+            return self.__access_token.token
 
-        raise Exception("❌ No metrics data found")
+    def wait_for_non_zero_count(self, query, timeout_seconds=300):
+        """
+        Run a query until it returns a non-zero count (polling as described in poll_until_non_zero).
+
+        Parameters:
+            query (str): Query in Kusto query language (KQL) that returns a single count.
+            timeout_seconds (int): How long to keep polling before giving up.
+        """
+
+        def probe():
+            r, error_message = self.run_query(query=query, timespan="P1D")
+            if r is None:
+                logging.warning(f"⚠️ Metrics query failed: {error_message}")
+                return 0
+            return r.rows[0][0]
+
+        poll_until_non_zero(probe, timeout_seconds)
 
     def __output_table(self, query_result: Table, title):
         """
@@ -328,7 +391,7 @@ class QueryProcessor:
             query_result (Table): the result of the ran query.
             title: the title of the query ran which describes its behaviour.
         """
-        print(tabulate(query_result.rows, query_result.columns))
+        print_table(query_result.columns, query_result.rows)
 
     def __output_chart(self, query_result: Table, title, columns, config=dict()):
         """
@@ -341,15 +404,19 @@ class QueryProcessor:
             config: The style configuration for the chart, info can be found here: https://github.com/kroitor/asciichart.
         """
 
+        if not STDOUT_IS_TTY:
+            # charts aren't readable outside a terminal so output the data instead
+            self.__output_table(query_result, title)
+            return
+
         def get_column_values(table: Table, column: str):
             try:
-                column_index = table.columns.index(column)
-            except ValueError:
+                return table.data[column]
+            except KeyError:
                 raise ValueError(
                     f"Column '{column}' not found in table columns: "
                     + ",".join(table.columns)
                 )
-            return [row[column_index] for row in table.rows]
 
         series = [get_column_values(query_result, column) for column in columns]
         print(asciichart.plot(series, config))
@@ -367,5 +434,4 @@ class QueryProcessor:
 
         # Extract column names
         columns = [column_tuple["name"] for column_tuple in json["columns"]]
-        rows = json["rows"]
-        return Table(columns=columns, rows=rows)
+        return Table.from_rows(columns=columns, rows=json["rows"])
@@ -1,5 +1,12 @@
 import os
 
+from azure.identity import (
+    AzureCliCredential,
+    ChainedTokenCredential,
+    EnvironmentCredential,
+    ManagedIdentityCredential,
+)
+
 apim_subscription_one_key = os.getenv("APIM_SUBSCRIPTION_ONE_KEY")
 apim_subscription_two_key = os.getenv("APIM_SUBSCRIPTION_TWO_KEY")
 apim_subscription_three_key = os.getenv("APIM_SUBSCRIPTION_THREE_KEY")
@@ -15,3 +22,17 @@ simulator_api_key = os.getenv("SIMULATOR_API_KEY")
 tenant_id = os.getenv("TENANT_ID")
 subscription_id = os.getenv("SUBSCRIPTION_ID")
 resource_group_name = os.getenv("RESOURCE_GROUP_NAME")
+
+
+def get_query_credential() -> ChainedTokenCredential:
+    """
+    Credential for querying test results.
+
+    Only tries the sources used to run the tests (CI, Azure hosted, local az login)
+    rather than probing everything DefaultAzureCredential supports.
+    """
+    return ChainedTokenCredential(
+        EnvironmentCredential(),
+        ManagedIdentityCredential(),
+        AzureCliCredential(),
+    )
@@ -1,8 +1,8 @@
 import base64
+import functools
+import gzip
 from datetime import UTC, datetime, timedelta
-import io
 import logging
-import time
 import requests
 import urllib.parse
 import json
@@ -10,73 +10,34 @@ import asciichartpy as asciichart
 
 from azure.core.credentials import TokenCredential
 from azure.core.exceptions import HttpResponseError
-from azure.monitor.query import LogsQueryClient, MetricsQueryClient, MetricsClient
-from dataclasses import dataclass
-from gzip import GzipFile
-from tabulate import tabulate
-from typing import Any
+from azure.monitor.query import (
+    LogsBatchQuery,
+    LogsQueryClient,
+    LogsQueryStatus,
+    MetricsQueryClient,
+    MetricsClient,
+)
 
-from .terminal import get_link
+from .query import _Query, poll_until_non_zero
+from .table import GroupDefinition, Table
+from .terminal import STDOUT_IS_TTY, colour, get_link, print_table
 
 
 APPINSIGHTS_ENDPOINT = "https://api.applicationinsights.io/v1/apps"
 
-# https://learn.microsoft.com/en-us/python/api/overview/azure/monitor-query-readme?view=azure-python
-
-
-## TODO extract this to separate file and share with AppInsights code
-@dataclass
-class GroupDefinition:
-    id_column: str
-    group_column: str
-    value_column: str
-    missing_value: Any = None
+# Maximum number of queries in a single batch request (service limit is 10)
+MAX_BATCH_SIZE = 10
 
+# https://learn.microsoft.com/en-us/python/api/overview/azure/monitor-query-readme?view=azure-python
 
-@dataclass
-class Table:
-    columns: list[str]
-    rows: list[list[Any]]
-
-    def group_by(
-        self,
-        id_column: str,
-        group_column: str,
-        value_column: str,
-        missing_value: Any = None,
-    ) -> "Table":
-
-        # assume rows are sorted on id_column
-
-        group_column_index = self.columns.index(group_column)
-        distinct_group_column_values = sorted(
-            list(set(row[group_column_index] for row in self.rows))
-        )
 
-        new_columns = [id_column] + [
-            f"{value_column}_{name}" for name in distinct_group_column_values
-        ]
+def format_kql_datetime(value: datetime) -> str:
+    """
+    Format a UTC datetime for use in a KQL datetime() literal, e.g. 2024-01-01T12:00:00Z.
+    """
+    return value.isoformat(timespec="seconds").replace("+00:00", "Z")
 
-        id_column_index = self.columns.index(id_column)
-        value_column_index = self.columns.index(value_column)
-
-        # Produce a new table where each row has the id_column and a column for each distinct value in group_column with the value of value_column
-        rows = []
-        current_row = None
-        for row in self.rows:
-            if current_row is None or current_row[0] != row[id_column_index]:
-                if current_row is not None:
-                    rows.append(current_row)
-                # start new row
-                current_row = [row[id_column_index]] + (
-                    [missing_value] * len(distinct_group_column_values)
-                )
-            group = row[group_column_index]
-            value = row[value_column_index]
-            current_row[distinct_group_column_values.index(group) + 1] = value
 
-        return Table(rows=rows, columns=new_columns)
-        
 def get_log_analytics_token_metric_url(
     tenant_id: str,
     subscription_id: str,
@@ -107,6 +68,7 @@ def get_log_analytics_token_metric_url(
     link = get_link("View Token Metrics in Log Analytics", url)
     return link
 
+@functools.lru_cache(maxsize=256)
 def get_log_analytics_portal_url(
     tenant_id: str,
     subscription_id: str,
@@ -116,23 +78,37 @@ def get_log_analytics_portal_url(
 ):
     """
     Build a URL to deep link into the Azure Portal to run a query in Log Analytics.
+    Results are cached so repeated run_queries calls with the same query reuse the URL.
     """
     # Get the UTF8 bytes for the query
     query_bytes = query.encode("utf-8")
 
-    # GZip the query bytes
-    bio_out = io.BytesIO()
-    with GzipFile(mode="wb", fileobj=bio_out) as gzip:
-        gzip.write(query_bytes)
+    # GZip the query bytes (mtime=0 so the same query always produces the same URL)
+    zipped_bytes = gzip.compress(query_bytes, compresslevel=6, mtime=0)
 
-    # Base64 encode the result
-    zipped_bytes = bio_out.getvalue()
-    base64_query = base64.b64encode(zipped_bytes)
+    # Base64 encode the result (base64 output is ASCII so decode to a str for quoting)
+    base64_query = base64.b64encode(zipped_bytes).decode("ascii")
 
     # URL encode the base64 encoded query
     encoded_query = urllib.parse.quote(base64_query, safe="")
 
-    return f"https://portal.azure.com#@{tenant_id}/blade/Microsoft_OperationsManagementSuite_Workspace/Logs.ReactView/resourceId/%2Fsubscriptions%2F{subscription_id}%2Fresourcegroups%2F{resource_group_name}%2Fproviders%2Fmicrosoft.operationalinsights%2Fworkspaces%2F{workspace_name}/source/LogsBlade.AnalyticsShareLinkToQuery/q/{encoded_query}"
+    resource_id = (
+        f"/subscriptions/{subscription_id}/resourcegroups/{resource_group_name}"
+        + f"/providers/microsoft.operationalinsights/workspaces/{workspace_name}"
+    )
+    path_segments = [
+        "blade",
+        "Microsoft_OperationsManagementSuite_Workspace",
+        "Logs.ReactView",
+        "resourceId",
+        urllib.parse.quote(resource_id, safe=""),
+        "source",
+        "LogsBlade.AnalyticsShareLinkToQuery",
+        "q",
+        encoded_query,
+    ]
+    encoded_tenant_id = urllib.parse.quote(tenant_id, safe="")
+    return f"https://portal.azure.com#@{encoded_tenant_id}/" + "/".join(path_segments)
 
 
 class QueryProcessor:
@@ -181,9 +157,9 @@ class QueryProcessor:
         validation_func=None,
         timespan="PT12H",
         is_chart=False,
-        columns=[],
+        columns=None,
         group_definition: GroupDefinition | None = None,
-        chart_config=dict(),
+        chart_config=None,
         show_query=False,
         include_link=False,
     ):
@@ -204,18 +180,28 @@ class QueryProcessor:
             include_link (bool): If true then a link to the query in the Azure Portal is printed. Requires tenant, subscription, resource group  and app insights name to be set
         """
 
+        if include_link and None in (
+            self.__tenant_id,
+            self.__subscription_id,
+            self.__resource_group_name,
+            self.__workspace_name,
+        ):
+            raise ValueError(
+                "tenant_id/subscription_id/resource_group_name/workspace_name are required when include_link=True"
+            )
+
         self.__queries.append(
-            (
-                title,
-                query,
-                validation_func,
-                timespan,
-                is_chart,
-                columns,
-                chart_config,
-                group_definition,
-                show_query,
-                include_link,
+            _Query(
+                title=title,
+                query=query,
+                validation_func=validation_func,
+                timespan=timespan,
+                is_chart=is_chart,
+                columns=columns or [],
+                chart_config=chart_config or {},
+                group_definition=group_definition,
+                show_query=show_query,
+                include_link=include_link,
             )
         )
 
@@ -223,26 +209,23 @@ class QueryProcessor:
         """
         Runs queries stored in __queries and prints result to stdout.
         """
+        query_results = self.__fetch_query_results()
+
         query_error_count = 0
-        for query_index, (
-            title,
-            query,
-            validation_func,
-            timespan,
-            is_chart,
-            columns,
-            chart_config,
-            group_definition,
-            show_query,
-            include_link,
-        ) in enumerate(self.__queries):
+        for query_index, (query_definition, (result, error_message)) in enumerate(
+            zip(self.__queries, query_results)
+        ):
+            title = query_definition.title
+            query = query_definition.query
+            group_definition = query_definition.group_definition
+            columns = query_definition.columns
             print()
             print(f"Running query {query_index + 1} of {len(self.__queries)}")
-            print(f"{asciichart.yellow}{title}{asciichart.reset}")
-            if show_query:
+            print(colour(title, asciichart.yellow))
+            if query_definition.show_query:
                 print(query)
                 print("")
-            if include_link:
+            if query_definition.include_link:
                 url = get_log_analytics_portal_url(
                     self.__tenant_id,
                     self.__subscription_id,
@@ -253,7 +236,6 @@ class QueryProcessor:
                 link = get_link("Run in Log Analytics", url)
                 print(link)
                 print("")
-            result, error_message = self.run_query(query, timespan)
 
             if error_message:
                 print()
@@ -279,17 +261,22 @@ class QueryProcessor:
                 ]
                 columns = sorted(columns)
 
-            if is_chart:
-                self.__output_chart(result, title, columns, chart_config)
+            if query_definition.is_chart:
+                self.__output_chart(
+                    result, title, columns, query_definition.chart_config
+                )
             else:
                 self.__output_table(result, title)
 
             # Validate result
-            if validation_func:
-                validation_error = validation_func(result)
+            if query_definition.validation_func:
+                validation_error = query_definition.validation_func(result)
                 if validation_error:
                     print(
-                        f"{asciichart.red}Query '{title}' failed with validation error: {validation_error}{asciichart.reset}"
+                        colour(
+                            f"Query '{title}' failed with validation error: {validation_error}",
+                            asciichart.red,
+                        )
                     )
                     query_error_count += 1
                     continue
@@ -298,6 +285,52 @@ class QueryProcessor:
 
         return query_error_count
 
+    def __fetch_query_results(self):
+        """
+        Runs the queries stored in __queries as batch requests (one round-trip per MAX_BATCH_SIZE queries).
+
+        Returns:
+            List of (result, error_message) tuples in the same order as __queries.
+        """
+        results = []
+        for batch_start in range(0, len(self.__queries), MAX_BATCH_SIZE):
+            batch = self.__queries[batch_start : batch_start + MAX_BATCH_SIZE]
+            results.extend(self.__run_batch(batch))
+        return results
+
+    def __run_batch(self, query_definitions) -> list[tuple[Table | None, str | None]]:
+        """
+        Runs a batch of queries in a single request.
+
+        Returns:
+            List of (result, error_message) tuples in the same order as query_definitions.
+        """
+        batch_queries = [
+            LogsBatchQuery(
+                workspace_id=self.__workspace_id,
+                query=query_definition.query,
+                timespan=query_definition.timespan,
+            )
+            for query_definition in query_definitions
+        ]
+        try:
+            responses = self.__logs_query_client.query_batch(batch_queries)
+        except HttpResponseError as e:
+            return [(None, e.message)] * len(query_definitions)
+
+        results = []
+        for response in responses:
+            if response.status == LogsQueryStatus.SUCCESS:
+                table = response.tables[0]
+                results.append(
+                    (Table.from_rows(columns=table.columns, rows=table.rows), None)
+                )
+            elif response.status == LogsQueryStatus.PARTIAL:
+                results.append((None, response.partial_error.message))
+            else:
+                results.append((None, response.message))
+        return results
+
     def run_query(self, query, timespan) -> tuple[Table, str]:
         """
         Runs a query on a given timespan.
@@ -322,27 +355,28 @@ class QueryProcessor:
             return None, e.message
 
         table = response.tables[0]
-        rows = table.rows
-        columns = table.columns
-        return Table(columns=columns, rows=rows), None
+        return Table.from_rows(columns=table.columns, rows=table.rows), None
 
-    def wait_for_non_zero_count(self, query, max_retries=10, wait_time_seconds=30):
+    def wait_for_non_zero_count(self, query, timeout_seconds=300):
         """
-        Run a query until it returns a non-zero count.
+        Run a query until it returns a non-zero count (polling as described in poll_until_non_zero).
+
+        Parameters:
+            query (str): Query in Kusto query language (KQL) that returns a single count.
+            timeout_seconds (int): How long to keep polling before giving up.
         """
-        for _ in range(max_retries):
-            r, _ = self.run_query(
+
+        def probe():
+            r, error_message = self.run_query(
                 query=query,
                 timespan=(datetime.now(UTC) - timedelta(days=1), datetime.now(UTC)),
             )
-            count = r.rows[0][0]
-            if count > 0:
-                logging.info("✔️ Found metrics data")
-                return
-            logging.info("⏳ Waiting for metrics data...")
-            time.sleep(wait_time_seconds)
+            if r is None:
+                logging.warning(f"⚠️ Metrics query failed: {error_message}")
+                return 0
+            return r.rows[0][0]
 
-        raise Exception("❌ No metrics data found")
+        poll_until_non_zero(probe, timeout_seconds)
 
     def build_token_metric_url(self, start_time, end_time): 
         """
@@ -368,7 +402,7 @@ class QueryProcessor:
             query_result (Table): the result of the ran query.
             title: the title of the query ran which describes its behaviour.
         """
-        print(tabulate(query_result.rows, query_result.columns))
+        print_table(query_result.columns, query_result.rows)
 
     def __output_chart(self, query_result: Table, title, columns, config=dict()):
         """
@@ -381,15 +415,19 @@ class QueryProcessor:
             config: The style configuration for the chart, info can be found here: https://github.com/kroitor/asciichart.
         """
 
+        if not STDOUT_IS_TTY:
+            # charts aren't readable outside a terminal so output the data instead
+            self.__output_table(query_result, title)
+            return
+
         def get_column_values(table: Table, column: str):
             try:
-                column_index = table.columns.index(column)
-            except ValueError:
+                return table.data[column]
+            except KeyError:
                 raise ValueError(
                     f"Column '{column}' not found in table columns: "
                     + ",".join(table.columns)
                 )
-            return [row[column_index] for row in table.rows]
 
         series = [get_column_values(query_result, column) for column in columns]
         print(asciichart.plot(series, config))
\ No newline at end of file
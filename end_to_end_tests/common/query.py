@@ -0,0 +1,59 @@
+import logging
+import random
+import time
+
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from .table import GroupDefinition, Table
+
+# Backoff between probes in poll_until_non_zero
+INITIAL_POLL_DELAY_SECONDS = 2.0
+MAX_POLL_DELAY_SECONDS = 30.0
+
+
+@dataclass(slots=True)
+class _Query:
+    """
+    A query queued on a QueryProcessor by add_query.
+    """
+
+    title: str
+    query: str
+    validation_func: Callable[[Table], Any] | None
+    timespan: Any
+    is_chart: bool
+    columns: list[str]
+    chart_config: dict
+    group_definition: GroupDefinition | None
+    show_query: bool
+    include_link: bool
+
+
+def poll_until_non_zero(probe: Callable[[], int], timeout_seconds: float = 300):
+    """
+    Call probe until it returns a non-zero count.
+
+    The first probe runs immediately. If it finds no data, later probes use jittered
+    exponential backoff (starting at 2s, capped at 30s), so data that arrives shortly
+    after the first probe is picked up within seconds rather than after a fixed 30s wait.
+
+    Parameters:
+        probe: Returns the current count (0 if it couldn't be determined).
+        timeout_seconds (float): How long to keep polling before giving up.
+    """
+    deadline = time.monotonic() + timeout_seconds
+    delay_seconds = INITIAL_POLL_DELAY_SECONDS
+    while True:
+        if probe() > 0:
+            logging.info("✔️ Found metrics data")
+            return
+
+        remaining_seconds = deadline - time.monotonic()
+        if remaining_seconds <= 0:
+            break
+        logging.info("⏳ Waiting for metrics data...")
+        time.sleep(min(delay_seconds + random.random() * 0.5, remaining_seconds))
+        delay_seconds = min(delay_seconds * 1.8, MAX_POLL_DELAY_SECONDS)
+
+    raise Exception("❌ No metrics data found")
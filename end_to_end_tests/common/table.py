@@ -0,0 +1,70 @@
+from dataclasses import dataclass
+from typing import Any
+
+
+@dataclass
+class GroupDefinition:
+    id_column: str
+    group_column: str
+    value_column: str
+    missing_value: Any = None
+
+
+@dataclass
+class Table:
+    """
+    Query result stored by column (column name -> list of values).
+    """
+
+    columns: list[str]
+    data: dict[str, list[Any]]
+
+    @classmethod
+    def from_rows(cls, columns: list[str], rows) -> "Table":
+        """
+        Constructs a table from a sequence of rows, transposing them into columns in a single pass.
+        """
+        data = {column: [] for column in columns}
+        if rows:
+            data.update(zip(columns, map(list, zip(*rows))))
+        return cls(columns=columns, data=data)
+
+    @property
+    def rows(self) -> list[list[Any]]:
+        """
+        The table values as a list of rows (e.g. for tabulate).
+        """
+        return [list(row) for row in zip(*(self.data[c] for c in self.columns))]
+
+    def group_by(
+        self,
+        id_column: str,
+        group_column: str,
+        value_column: str,
+        missing_value: Any = None,
+    ) -> "Table":
+
+        distinct_group_column_values = sorted(dict.fromkeys(self.data[group_column]))
+
+        # Produce a new table with the id_column and a column for each distinct value in group_column with the value of value_column
+        # Factorize id_column into row indexes (first-seen order) so the input doesn't need to be sorted
+        # and each group column can be allocated up front rather than grown row by row
+        row_index_by_id = {}
+        row_indexes = [
+            row_index_by_id.setdefault(id_value, len(row_index_by_id))
+            for id_value in self.data[id_column]
+        ]
+        row_count = len(row_index_by_id)
+        group_values = {
+            group: [missing_value] * row_count for group in distinct_group_column_values
+        }
+        for row_index, group, value in zip(
+            row_indexes, self.data[group_column], self.data[value_column]
+        ):
+            group_values[group][row_index] = value
+
+        data = {id_column: list(row_index_by_id)}
+        for group, values in group_values.items():
+            data[f"{value_column}_{group}"] = values
+
+        return Table(columns=list(data), data=data)
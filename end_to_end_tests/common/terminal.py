@@ -1,2 +1,37 @@
+import csv
+import sys
+
+from tabulate import tabulate
+
+# When stdout isn't a terminal (e.g. piped to a CI log) skip escape codes and charts and output tables as CSV
+STDOUT_IS_TTY = sys.stdout.isatty()
+
+RESET = "\033[0m"
+
+
 def get_link(title: str, url: str):
+    if not STDOUT_IS_TTY:
+        return f"{title}: {url}"
     return "\033]8;;{}\033\\{}\033]8;;\033\\".format(url, title)
+
+
+def colour(text: str, code: str):
+    """
+    Wraps text in an ANSI colour code (e.g. asciichart.yellow) when stdout is a terminal.
+    """
+    if not STDOUT_IS_TTY:
+        return text
+    return f"{code}{text}{RESET}"
+
+
+def print_table(columns: list[str], rows: list[list]):
+    """
+    Prints a table, formatted with tabulate in a terminal or as CSV otherwise.
+    """
+    if not STDOUT_IS_TTY:
+        writer = csv.writer(sys.stdout, lineterminator="\n")
+        writer.writerow(columns)
+        writer.writerows(rows)
+        return
+
+    print(tabulate(rows, columns))
@@ -1,12 +1,13 @@
 from datetime import datetime, timedelta, UTC
 import logging
-import time
 
 import asciichartpy as asciichart
-from azure.identity import DefaultAzureCredential
+import gevent
+import orjson
 from locust import HttpUser, task, constant, events
 
 from common.log_analytics import (
+    format_kql_datetime,
     GroupDefinition,
     QueryProcessor,
 )
@@ -16,6 +17,7 @@ from common.latency import (
     report_request_metric,
 )
 from common.config import (
+    get_query_credential,
     apim_subscription_one_key,
     app_insights_connection_string,
     simulator_endpoint_payg1,
@@ -38,20 +40,30 @@ class CompletionUser(HttpUser):
 
     wait_time = constant(1)  # wait 1 second between requests
 
-    @task
-    def get_completion(self):
-        url = f"openai/deployments/{deployment_name}/completions?api-version=2023-05-15"
-        payload = {
+    # The request is the same every time so build the URL and serialize the body once
+    request_url = (
+        f"openai/deployments/{deployment_name}/completions?api-version=2023-05-15"
+    )
+    request_body = orjson.dumps(
+        {
             "model": "gpt-5-turbo-1",
             "prompt": "Once upon a time",
             "max_tokens": 10,
         }
-        self.client.post(
-            url,
-            json=payload,
-            headers={"ocp-apim-subscription-key": apim_subscription_one_key},
+    )
+
+    def on_start(self):
+        self.client.headers.update(
+            {
+                "ocp-apim-subscription-key": apim_subscription_one_key,
+                "Content-Type": "application/json",
+            }
         )
 
+    @task
+    def get_completion(self):
+        self.client.post(self.request_url, data=self.request_body)
+
 
 class TestCoordinationUser(HttpUser):
     """
@@ -62,44 +74,34 @@ class TestCoordinationUser(HttpUser):
 
     @task
     def orchestrate_test(self):
-        # Run for 1 minute
-        time.sleep(60)
-
-        # Measure the latencies and update APIM
-        # The load test repeatedly does this to simulate the scheduled task that would run in production
-        logging.info("⌚ Measuring latencies and updating APIM")
-        measure_latency_and_update_apim()
-
-        # Run for 1 minute
-        time.sleep(60)
-
-        # Measure the latencies and update APIM
-        logging.info("⌚ Measuring latencies and updating APIM")
-        measure_latency_and_update_apim()
-
-        # Reverse the latencies
-        # Note that this happening _after_ the latency measurement
+        # Each step runs the load for 1 minute and then performs the step's actions
+        # The load test repeatedly measures the latencies and updates APIM to simulate the scheduled task that would run in production
+        # Note that reversing the latencies _after_ the latency measurement
         # means that we will see the latency increase in the front-end requests
         # until the next measure/update cycle
-        logging.info("⚙️ Updating simulator latencies (PAYG1 slow, PAYG2 fast)")
-        set_simulator_completions_latency(simulator_endpoint_payg1, 100)
-        set_simulator_completions_latency(simulator_endpoint_payg2, 10)
-
-        # Run for 1 minute
-        time.sleep(60)
-
-        # Measure the latencies and update APIM
-        logging.info("⌚ Measuring latencies and updating APIM")
-        measure_latency_and_update_apim()
-
-        # Run for 1 minute
-        time.sleep(60)
+        schedule = [
+            [measure_latencies],
+            [measure_latencies, reverse_latencies],
+            [measure_latencies],
+            [measure_latencies],
+            [],
+        ]
+        for actions in schedule:
+            # gevent.sleep yields to the other users on this worker
+            gevent.sleep(60)
+            for action in actions:
+                action()
+
+
+def measure_latencies():
+    logging.info("⌚ Measuring latencies and updating APIM")
+    measure_latency_and_update_apim()
 
-        # Measure the latencies and update APIM
-        logging.info("⌚ Measuring latencies and updating APIM")
-        measure_latency_and_update_apim()
 
-        time.sleep(60)  # sleep for 2 minutes
+def reverse_latencies():
+    logging.info("⚙️ Updating simulator latencies (PAYG1 slow, PAYG2 fast)")
+    set_simulator_completions_latency(simulator_endpoint_payg1, 100)
+    set_simulator_completions_latency(simulator_endpoint_payg2, 10)
 
 
 @events.init.add_listener
@@ -132,7 +134,7 @@ def on_test_start(environment, **kwargs):
     set_simulator_completions_latency(simulator_endpoint_payg1, 10)
     set_simulator_completions_latency(simulator_endpoint_payg2, 100)
 
-    time.sleep(1)
+    gevent.sleep(1)
     logging.info("⌚ Measuring API latencies and updating APIM")
     measure_latency_and_update_apim()
 
@@ -150,7 +152,7 @@ def on_test_stop(environment, **kwargs):
 
     query_processor = QueryProcessor(
         workspace_id=log_analytics_workspace_id,
-        token_credential=DefaultAzureCredential(),
+        token_credential=get_query_credential(),
         tenant_id=tenant_id,
         subscription_id=subscription_id,
         resource_group_name=resource_group_name,
@@ -160,12 +162,12 @@ def on_test_stop(environment, **kwargs):
     metric_check_time = test_stop_time - timedelta(seconds=10)
     check_results_query = f"""
     AppMetrics
-    | where TimeGenerated >= datetime({metric_check_time.strftime('%Y-%m-%dT%H:%M:%SZ')}) and Name == "locust.request_latency"
+    | where TimeGenerated >= datetime({format_kql_datetime(metric_check_time)}) and Name == "locust.request_latency"
     | count
     """
     query_processor.wait_for_non_zero_count(check_results_query)
 
-    time_range = f"TimeGenerated > datetime({test_start_time.strftime('%Y-%m-%dT%H:%M:%SZ')}) and TimeGenerated < datetime({test_stop_time.strftime('%Y-%m-%dT%H:%M:%SZ')})"
+    time_range = f"TimeGenerated > datetime({format_kql_datetime(test_start_time)}) and TimeGenerated < datetime({format_kql_datetime(test_stop_time)})"
 
     query_processor.add_query(
         title="Request latency (PAYG1 -> Blue, PAYG2 -> Yellow)",
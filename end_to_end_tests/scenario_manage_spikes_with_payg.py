@@ -2,10 +2,11 @@ from datetime import datetime, timedelta, UTC
 import logging
 
 import asciichartpy as asciichart
-from azure.identity import DefaultAzureCredential
+import orjson
 from locust import HttpUser, LoadTestShape, task, constant, events
 
 from common.log_analytics import (
+    format_kql_datetime,
     GroupDefinition,
     QueryProcessor,
 )
@@ -14,6 +15,7 @@ from common.latency import (
     report_request_metric,
 )
 from common.config import (
+    get_query_credential,
     apim_subscription_one_key,
     simulator_endpoint_ptu1,
     simulator_endpoint_payg1,
@@ -57,10 +59,10 @@ class ChatCompletionUser(HttpUser):
 
     wait_time = constant(1)  # wait 1 second between requests
 
-    @task
-    def get_completion(self):
-        url = f"openai/deployments/{deployment_name}/chat/completions?api-version=2023-05-15"
-        payload = {
+    # The request is the same every time so build the URL and serialize the body once
+    request_url = f"openai/deployments/{deployment_name}/chat/completions?api-version=2023-05-15"
+    request_body = orjson.dumps(
+        {
             "messages": [
                 {"role": "user", "content": "Lorem ipsum dolor sit amet?"},
                 {
@@ -107,12 +109,20 @@ class ChatCompletionUser(HttpUser):
             "model": "gpt-5-turbo-1",
             "max_tokens": 1000,
         }
+    )
+
+    def on_start(self):
+        self.client.headers.update(
+            {
+                "ocp-apim-subscription-key": apim_subscription_one_key,
+                "Content-Type": "application/json",
+            }
+        )
+
+    @task
+    def get_completion(self):
         try:
-            self.client.post(
-                url,
-                json=payload,
-                headers={"ocp-apim-subscription-key": apim_subscription_one_key},
-            )
+            self.client.post(self.request_url, data=self.request_body)
         except Exception as e:
             print()
             logging.error(e)
@@ -163,7 +173,7 @@ def on_test_stop(environment, **kwargs):
 
     query_processor = QueryProcessor(
         workspace_id=log_analytics_workspace_id,
-        token_credential=DefaultAzureCredential(),
+        token_credential=get_query_credential(),
         tenant_id=tenant_id,
         subscription_id=subscription_id,
         resource_group_name=resource_group_name,
@@ -173,12 +183,12 @@ def on_test_stop(environment, **kwargs):
     metric_check_time = test_stop_time - timedelta(seconds=10)
     check_results_query = f"""
     AppMetrics
-    | where TimeGenerated >= datetime({metric_check_time.strftime('%Y-%m-%dT%H:%M:%SZ')}) and Name == "locust.request_latency"
+    | where TimeGenerated >= datetime({format_kql_datetime(metric_check_time)}) and Name == "locust.request_latency"
     | count
     """
     query_processor.wait_for_non_zero_count(check_results_query)
 
-    time_range = f"TimeGenerated > datetime({test_start_time.strftime('%Y-%m-%dT%H:%M:%SZ')}) and TimeGenerated < datetime({test_stop_time.strftime('%Y-%m-%dT%H:%M:%SZ')})"
+    time_range = f"TimeGenerated > datetime({format_kql_datetime(test_start_time)}) and TimeGenerated < datetime({format_kql_datetime(test_stop_time)})"
 
     query_processor.add_query(
         title="Overall request count",
@@ -2,10 +2,11 @@ from datetime import datetime, timedelta, UTC
 import logging
 
 import asciichartpy as asciichart
-from azure.identity import DefaultAzureCredential
+import orjson
 from locust import HttpUser, task, constant, events
 
 from common.log_analytics import (
+    format_kql_datetime,
     GroupDefinition,
     QueryProcessor,
 )
@@ -14,6 +15,7 @@ from common.latency import (
     report_request_metric,
 )
 from common.config import (
+    get_query_credential,
     apim_subscription_one_key,
     simulator_endpoint_payg1,
     simulator_endpoint_payg2,
@@ -36,20 +38,30 @@ class CompletionUser(HttpUser):
 
     wait_time = constant(1)  # wait 1 second between requests
 
-    @task
-    def get_completion(self):
-        url = f"openai/deployments/{deployment_name}/completions?api-version=2023-05-15"
-        payload = {
+    # The request is the same every time so build the URL and serialize the body once
+    request_url = (
+        f"openai/deployments/{deployment_name}/completions?api-version=2023-05-15"
+    )
+    request_body = orjson.dumps(
+        {
             "model": "gpt-5-turbo-1",
             "prompt": "Once upon a time",
             "max_tokens": 10,
         }
-        self.client.post(
-            url,
-            json=payload,
-            headers={"ocp-apim-subscription-key": apim_subscription_one_key},
+    )
+
+    def on_start(self):
+        self.client.headers.update(
+            {
+                "ocp-apim-subscription-key": apim_subscription_one_key,
+                "Content-Type": "application/json",
+            }
         )
 
+    @task
+    def get_completion(self):
+        self.client.post(self.request_url, data=self.request_body)
+
 
 @events.init.add_listener
 def on_locust_init(environment, **kwargs):
@@ -95,7 +107,7 @@ def on_test_stop(environment, **kwargs):
 
     query_processor = QueryProcessor(
         workspace_id=log_analytics_workspace_id,
-        token_credential=DefaultAzureCredential(),
+        token_credential=get_query_credential(),
         tenant_id=tenant_id,
         subscription_id=subscription_id,
         resource_group_name=resource_group_name,
@@ -105,12 +117,12 @@ def on_test_stop(environment, **kwargs):
     metric_check_time = test_stop_time - timedelta(seconds=10)
     check_results_query = f"""
     AppMetrics
-    | where TimeGenerated >= datetime({metric_check_time.strftime('%Y-%m-%dT%H:%M:%SZ')}) and Name == "locust.request_latency"
+    | where TimeGenerated >= datetime({format_kql_datetime(metric_check_time)}) and Name == "locust.request_latency"
     | count
     """
     query_processor.wait_for_non_zero_count(check_results_query)
 
-    time_range = f"TimeGenerated > datetime({test_start_time.strftime('%Y-%m-%dT%H:%M:%SZ')}) and TimeGenerated < datetime({test_stop_time.strftime('%Y-%m-%dT%H:%M:%SZ')})"
+    time_range = f"TimeGenerated > datetime({format_kql_datetime(test_start_time)}) and TimeGenerated < datetime({format_kql_datetime(test_stop_time)})"
 
     query_processor.add_query(
         title="Request latency (PAYG1 -> Blue, PAYG2 -> Yellow)",
@@ -2,12 +2,12 @@ from datetime import datetime, timedelta, UTC
 import logging
 
 import asciichartpy as asciichart
-from azure.identity import DefaultAzureCredential
 from locust import HttpUser, task, constant, events
 
 import random
 
 from common.log_analytics import (
+    format_kql_datetime,
     GroupDefinition,
     QueryProcessor,
 )
@@ -16,6 +16,7 @@ from common.latency import (
     report_request_metric,
 )
 from common.config import (
+    get_query_credential,
     apim_subscription_one_key,
     apim_subscription_two_key,
     apim_subscription_three_key,
@@ -100,7 +101,7 @@ def on_test_stop(environment, **kwargs):
 
     query_processor = QueryProcessor(
         workspace_id=log_analytics_workspace_id,
-        token_credential=DefaultAzureCredential(),
+        token_credential=get_query_credential(),
         tenant_id=tenant_id,
         subscription_id=subscription_id,
         resource_group_name=resource_group_name,
@@ -111,12 +112,12 @@ def on_test_stop(environment, **kwargs):
     metric_check_time = test_stop_time - timedelta(seconds=10)
     check_results_query = f"""
     AppMetrics
-    | where TimeGenerated >= datetime({metric_check_time.strftime('%Y-%m-%dT%H:%M:%SZ')}) and Name == "locust.request_latency"
+    | where TimeGenerated >= datetime({format_kql_datetime(metric_check_time)}) and Name == "locust.request_latency"
     | count
     """
     query_processor.wait_for_non_zero_count(check_results_query)
 
-    time_range = f"TimeGenerated > datetime({test_start_time.strftime('%Y-%m-%dT%H:%M:%SZ')}) and TimeGenerated < datetime({test_stop_time.strftime('%Y-%m-%dT%H:%M:%SZ')})"
+    time_range = f"TimeGenerated > datetime({format_kql_datetime(test_start_time)}) and TimeGenerated < datetime({format_kql_datetime(test_stop_time)})"
 
     query_processor.add_query(
         title="Overall request count",